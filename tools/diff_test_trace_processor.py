@@ -18,9 +18,12 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import collections
 import concurrent.futures
 import datetime
 import difflib
+import functools
+import io
 import json
 import os
 import re
@@ -28,9 +31,23 @@ import signal
 import subprocess
 import sys
 import tempfile
+import threading
 
 from google.protobuf import text_format
 
+# Optional: only used to diff large outputs. It is not installed by
+# tools/install-build-deps, so large outputs fall back to difflib unless it is
+# installed separately (pip install diff-match-patch).
+try:
+  from diff_match_patch import diff_match_patch
+except ImportError:
+  diff_match_patch = None
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
 from proto_utils import create_message_factory, serialize_textproto_trace, serialize_python_trace
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -47,8 +64,45 @@ elif sys.platform.startswith('darwin'):
 elif sys.platform.startswith('win32'):
   ENV['PATH'] = os.path.join(ROOT_DIR, 'buildtools', 'win', 'clang', 'bin')
 
+# Matches the test lines of an index file, skipping comments and blank lines:
+# <trace> <query file or metric> <expected output>
+INDEX_LINE_PATTERN = re.compile(
+    r'^[ \t]*([^#\s]\S*)[ \t]+(\S+)[ \t]+(\S+)[ \t]*$', re.MULTILINE)
+
+# Matches every line of an index file which is neither blank nor a comment.
+INDEX_NON_COMMENT_LINE_PATTERN = re.compile(r'^[ \t]*[^#\s]', re.MULTILINE)
+
 USE_COLOR_CODES = sys.stderr.isatty()
 
+# Whether generated traces can be passed to trace processor through a pipe
+# (as /dev/fd/N) rather than through a temporary file.
+USE_TRACE_PIPES = not sys.platform.startswith('win32') and os.path.isdir(
+    '/dev/fd')
+
+# Outputs with at most this many lines are diffed with difflib. Above that,
+# difflib's quadratic matching can dominate the runtime of a failing test so
+# diff-match-patch (when available) is used instead.
+DIFFLIB_MAX_LINES = 1000
+
+# Number of unchanged lines shown around each change, as in unified diffs.
+DIFF_CONTEXT_LINES = 3
+
+# Outputs larger than this are not diffed at all: only the position of the
+# first difference is reported.
+MAX_DIFF_INPUT_SIZE = 256 * 1024
+
+# Number of bytes shown on each side of the first difference when the
+# outputs are too large to be diffed.
+MISMATCH_WINDOW_SIZE = 200
+
+# Test output is written to stderr once this many results have accumulated, or
+# earlier if the next results are not ready yet.
+STDERR_FLUSH_RESULTS = 32
+
+# The details (stderr, command lines, diff) printed for a failed test are cut
+# after this many characters.
+MAX_FAILURE_DETAILS_SIZE = 64 * 1024
+
 def red(no_colors):
   return "\u001b[31m" if USE_COLOR_CODES and not no_colors else ""
 
@@ -67,11 +121,61 @@ def end_color(no_colors):
 
 class Test(object):
 
-  def __init__(self, type, trace_path, query_path_or_metric, expected_path):
+  def __init__(self,
+               type,
+               trace_path,
+               query_path_or_metric,
+               expected_path,
+               missing_file_error=None):
     self.type = type
     self.trace_path = trace_path
     self.query_path_or_metric = query_path_or_metric
     self.expected_path = expected_path
+    # Set when one of the files needed by the test does not exist. The test
+    # is then reported as failed without being run.
+    self.missing_file_error = missing_file_error
+
+
+class TracePipe(object):
+  """Streams an in-memory trace to trace processor through a pipe.
+
+  Trace processor reads the trace from |path|, which is inherited by its
+  subprocess. close() must be called once trace processor has exited.
+
+  As trace processor cannot mmap a pipe, it falls back on read() to load the
+  trace, so this must not be used when measuring the ingestion time.
+  """
+
+  def __init__(self, data):
+    self.fd, write_fd = os.pipe()
+    os.set_inheritable(self.fd, True)
+    self.path = f"/dev/fd/{self.fd}"
+    # A daemon thread so that a writer that is stuck for whatever reason can
+    # never keep the worker process alive.
+    self.writer = threading.Thread(
+        target=self._write, args=(write_fd, data), daemon=True)
+    self.writer.start()
+
+  @staticmethod
+  def _write(write_fd, data):
+    try:
+      with open(write_fd, 'wb') as f:
+        f.write(data)
+    except BrokenPipeError:
+      # Trace processor exited without reading the whole trace.
+      pass
+
+  def close(self):
+    # Closing the read end unblocks the writer if it is still writing.
+    os.close(self.fd)
+    self.writer.join()
+
+
+# Returned by run_test(). Only made of primitive types to keep it cheap to
+# send back from the worker processes.
+TestOutcome = collections.namedtuple('TestOutcome', [
+    'name', 'passed', 'result_str', 'ingest_time_ns', 'real_time_ns'
+])
 
 
 class PerfResult(object):
@@ -104,22 +208,180 @@ def create_metrics_message_factory(metrics_descriptor_paths):
                                 'perfetto.protos.TraceMetrics')
 
 
+@functools.lru_cache(maxsize=None)
+def cached_metrics_message_factory(metrics_descriptor_paths,
+                                   metrics_descriptor_mtimes):
+  # The mtimes are only part of the cache key: they make sure that a rebuilt
+  # descriptor is parsed again.
+  del metrics_descriptor_mtimes
+  return create_metrics_message_factory(list(metrics_descriptor_paths))
+
+
+def get_metrics_message_factory(metrics_descriptor_paths):
+  # Parsing the descriptors is expensive so do it at most once per process.
+  return cached_metrics_message_factory(
+      metrics_descriptor_paths,
+      tuple(os.path.getmtime(p) for p in metrics_descriptor_paths))
+
+
 def write_diff(expected, actual):
-  expected_lines = expected.splitlines(True)
-  actual_lines = actual.splitlines(True)
-  diff = difflib.unified_diff(
-      expected_lines, actual_lines, fromfile='expected', tofile='actual')
-  res = ""
-  for line in diff:
-    res += line
+  """Returns a diff of two outputs given as bytes."""
+  if max(len(expected), len(actual)) > MAX_DIFF_INPUT_SIZE:
+    return write_mismatch_summary(expected, actual)
+
+  expected = expected.decode('utf8')
+  actual = actual.decode('utf8')
+
+  if diff_match_patch is not None and max(
+      expected.count('\n'), actual.count('\n')) > DIFFLIB_MAX_LINES:
+    return write_dmp_diff(expected, actual)
+
+  return ''.join(
+      difflib.unified_diff(
+          expected.splitlines(keepends=True),
+          actual.splitlines(keepends=True),
+          fromfile='expected',
+          tofile='actual'))
+
+
+def write_mismatch_summary(expected, actual):
+  mismatch = next(
+      (i for i, (a, b) in enumerate(zip(expected, actual)) if a != b),
+      min(len(expected), len(actual)))
+  line = expected.count(b'\n', 0, mismatch) + 1
+  start = max(0, mismatch - MISMATCH_WINDOW_SIZE)
+  end = mismatch + MISMATCH_WINDOW_SIZE
+  # The window may cut a multi-byte character in half.
+  expected_window = expected[start:end].decode('utf8', errors='replace')
+  actual_window = actual[start:end].decode('utf8', errors='replace')
+  res = f"<expected {len(expected)} bytes> != <actual {len(actual)} bytes>; "
+  res += f"first diverging line: {line}\n"
+  res += f"Expected (around byte {mismatch}):\n{expected_window}\n"
+  res += f"Actual (around byte {mismatch}):\n{actual_window}\n"
+  return res
+
+
+def split_lines(text):
+  """Splits |text| on '\n' only, like diff_match_patch does, keeping ends."""
+  lines = text.split('\n')
+  res = [line + '\n' for line in lines[:-1]]
+  if lines[-1]:
+    res.append(lines[-1])
   return res
 
 
+def format_unified_range(start, stop):
+  # Same format as the ranges of difflib.unified_diff's hunk headers.
+  beginning = start + 1
+  length = stop - start
+  if length == 1:
+    return f"{beginning}"
+  if not length:
+    beginning -= 1
+  return f"{beginning},{length}"
+
+
+def write_dmp_diff(expected, actual):
+  dmp = diff_match_patch()
+  dmp.Diff_Timeout = 1.0
+
+  # Diff line by line: each distinct line is mapped to a single character so
+  # the diff (and the semantic cleanup) never splits a line in the middle.
+  expected_chars, actual_chars, line_array = dmp.diff_linesToChars(
+      expected, actual)
+  diffs = dmp.diff_main(expected_chars, actual_chars, False)
+  dmp.diff_cleanupSemantic(diffs)
+  dmp.diff_charsToLines(diffs, line_array)
+
+  # Convert the diffs to (op, expected_start, expected_end, actual_start,
+  # actual_end) line ranges, like difflib's opcodes.
+  expected_lines = []
+  actual_lines = []
+  codes = []
+  for op, text in diffs:
+    lines = split_lines(text)
+    i = len(expected_lines)
+    j = len(actual_lines)
+    if op != dmp.DIFF_INSERT:
+      expected_lines.extend(lines)
+    if op != dmp.DIFF_DELETE:
+      actual_lines.extend(lines)
+    codes.append((op, i, len(expected_lines), j, len(actual_lines)))
+
+  # Group the changes into hunks with DIFF_CONTEXT_LINES lines of context,
+  # as difflib.SequenceMatcher.get_grouped_opcodes() does.
+  n = DIFF_CONTEXT_LINES
+  if codes and codes[0][0] == dmp.DIFF_EQUAL:
+    op, i1, i2, j1, j2 = codes[0]
+    codes[0] = op, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+  if codes and codes[-1][0] == dmp.DIFF_EQUAL:
+    op, i1, i2, j1, j2 = codes[-1]
+    codes[-1] = op, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+  groups = []
+  group = []
+  for op, i1, i2, j1, j2 in codes:
+    if op == dmp.DIFF_EQUAL and i2 - i1 > 2 * n:
+      group.append((op, i1, i1 + n, j1, j1 + n))
+      groups.append(group)
+      group = []
+      i1, j1 = i2 - n, j2 - n
+    group.append((op, i1, i2, j1, j2))
+  if group and not (len(group) == 1 and group[0][0] == dmp.DIFF_EQUAL):
+    groups.append(group)
+
+  res = ['--- expected\n', '+++ actual\n']
+  for group in groups:
+    expected_range = format_unified_range(group[0][1], group[-1][2])
+    actual_range = format_unified_range(group[0][3], group[-1][4])
+    res.append(f"@@ -{expected_range} +{actual_range} @@\n")
+    for op, i1, i2, j1, j2 in group:
+      if op == dmp.DIFF_INSERT:
+        prefix, lines = '+', actual_lines[j1:j2]
+      else:
+        prefix = '-' if op == dmp.DIFF_DELETE else ' '
+        lines = expected_lines[i1:i2]
+      for line in lines:
+        res.append(prefix + line)
+        if not line.endswith('\n'):
+          res.append('\n\\ No newline at end of file\n')
+  return ''.join(res)
+
+
+def run_trace_processor(cmd):
+  # Each test runs in a fresh trace_processor_shell: the shell cannot load more
+  # than one trace per process and --perf-file reports the timings of the
+  # whole process, so there is no state to reuse across tests.
+  # File descriptors created by Python are not inherited by default (PEP 446)
+  # so skip close_fds, which closes every possible fd in the child and is slow
+  # when the fd limit is high.
+  return subprocess.run(
+      cmd,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE,
+      env=ENV,
+      close_fds=False)
+
+
+# Several tests usually share the same generated trace and are next to each
+# other in the index, so they end up in the same chunk of tests sent to a
+# worker. The inputs don't change during a run, which is as long as the cache
+# lives, so there is no need to key it on their mtimes.
+@functools.lru_cache(maxsize=32)
+def generate_trace(trace_descriptor_path, extension_descriptor_paths,
+                   trace_path):
+  """Returns the serialized trace generated from a .py or .textproto file."""
+  gen_trace = io.BytesIO()
+  if trace_path.endswith('.py'):
+    serialize_python_trace(trace_descriptor_path, trace_path, gen_trace)
+  else:
+    serialize_textproto_trace(trace_descriptor_path,
+                              list(extension_descriptor_paths), trace_path,
+                              gen_trace)
+  return gen_trace.getvalue()
+
+
 def run_metrics_test(trace_processor_path, gen_trace_path, metric,
                      expected_path, perf_path, metrics_message_factory):
-  with open(expected_path, 'r') as expected_file:
-    expected = expected_file.read()
-
   json_output = os.path.basename(expected_path).endswith('.json.out')
   cmd = [
       trace_processor_path,
@@ -130,37 +392,43 @@ def run_metrics_test(trace_processor_path, gen_trace_path, metric,
       perf_path,
       gen_trace_path,
   ]
-  tp = subprocess.Popen(
-      cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=ENV)
-  (stdout, stderr) = tp.communicate()
+  tp = run_trace_processor(cmd)
 
   if json_output:
-    expected_text = expected
-    actual_text = stdout.decode('utf8')
+    with open(expected_path, 'rb') as expected_file:
+      expected_text = expected_file.read()
+    actual_text = tp.stdout
   else:
     # Expected will be in text proto format and we'll need to parse it to
     # a real proto.
+    with open(expected_path, 'rb') as expected_file:
+      expected = expected_file.read()
     expected_message = metrics_message_factory()
     text_format.Merge(expected, expected_message)
 
     # Actual will be the raw bytes of the proto and we'll need to parse it
     # into a message.
     actual_message = metrics_message_factory()
-    actual_message.ParseFromString(stdout)
-
-    # Convert both back to text format.
-    expected_text = text_format.MessageToString(expected_message)
-    actual_text = text_format.MessageToString(actual_message)
+    actual_message.ParseFromString(tp.stdout)
+
+    # Comparing the serialized messages is much cheaper than converting both
+    # back to text format, which is only needed to show a diff.
+    expected_proto = expected_message.SerializeToString(deterministic=True)
+    actual_proto = actual_message.SerializeToString(deterministic=True)
+    if expected_proto == actual_proto:
+      expected_text = expected_proto
+      actual_text = actual_proto
+    else:
+      expected_text = text_format.MessageToString(expected_message).encode(
+          'utf8')
+      actual_text = text_format.MessageToString(actual_message).encode('utf8')
 
   return TestResult('metric', metric, gen_trace_path, cmd, expected_text,
-                    actual_text, stderr.decode('utf8'), tp.returncode)
+                    actual_text, tp.stderr.decode('utf8'), tp.returncode)
 
 
 def run_query_test(trace_processor_path, gen_trace_path, query_path,
                    expected_path, perf_path):
-  with open(expected_path, 'r') as expected_file:
-    expected = expected_file.read()
-
   cmd = [
       trace_processor_path,
       '-q',
@@ -169,34 +437,19 @@ def run_query_test(trace_processor_path, gen_trace_path, query_path,
       perf_path,
       gen_trace_path,
   ]
-  tp = subprocess.Popen(
-      cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=ENV)
-  (stdout, stderr) = tp.communicate()
+  tp = run_trace_processor(cmd)
+  with open(expected_path, 'rb') as expected_file:
+    expected = expected_file.read()
   return TestResult('query', query_path, gen_trace_path, cmd, expected,
-                    stdout.decode('utf8'), stderr.decode('utf8'), tp.returncode)
+                    tp.stdout, tp.stderr.decode('utf8'), tp.returncode)
 
 
-def run_test(trace_descriptor_path, extension_descriptor_paths, args, test):
+def run_test(trace_descriptor_path, extension_descriptor_paths,
+             metrics_message_factory, args, test):
   """
   Returns:
-    test_name -> str,
-    passed -> bools,
-    result_str -> str,
-    perf_data -> str
+    TestOutcome. ingest_time_ns and real_time_ns are None if the test failed.
   """
-  out_path = os.path.dirname(args.trace_processor)
-  if args.metrics_descriptor:
-    metrics_descriptor_paths = [args.metrics_descriptor]
-  else:
-    metrics_protos_path = os.path.join(out_path, 'gen', 'protos', 'perfetto',
-                                       'metrics')
-    metrics_descriptor_paths = [
-        os.path.join(metrics_protos_path, 'metrics.descriptor'),
-        os.path.join(metrics_protos_path, 'chrome',
-                     'all_chrome_metrics.descriptor')
-    ]
-  metrics_message_factory = create_message_factory(
-      metrics_descriptor_paths, 'perfetto.protos.TraceMetrics')
   result_str = ""
   red_str = red(args.no_colors)
   green_str = green(args.no_colors)
@@ -206,62 +459,64 @@ def run_test(trace_descriptor_path, extension_descriptor_paths, args, test):
   test_name = f"{os.path.basename(test.query_path_or_metric)}\
   {os.path.basename(trace_path)}"
 
-  if not os.path.exists(trace_path):
-    result_str += f"Trace file not found {trace_path}\n"
-    return test_name, False, result_str, ""
-  elif not os.path.exists(expected_path):
-    result_str = f"Expected file not found {expected_path}"
-    return test_name, False, result_str, ""
+  if test.missing_file_error:
+    return TestOutcome(test_name, False, test.missing_file_error, None, None)
 
   is_generated_trace = trace_path.endswith('.py') or trace_path.endswith(
       '.textproto')
-  if trace_path.endswith('.py'):
-    gen_trace_file = tempfile.NamedTemporaryFile(delete=False)
-    serialize_python_trace(trace_descriptor_path, trace_path, gen_trace_file)
-    gen_trace_path = os.path.realpath(gen_trace_file.name)
-  elif trace_path.endswith('.textproto'):
-    gen_trace_file = tempfile.NamedTemporaryFile(delete=False)
-    serialize_textproto_trace(trace_descriptor_path, extension_descriptor_paths,
-                              trace_path, gen_trace_file)
-    gen_trace_path = os.path.realpath(gen_trace_file.name)
-  else:
-    gen_trace_file = None
-    gen_trace_path = trace_path
-
   # We can't use delete=True here. When using that on Windows, the
   # resulting file is opened in exclusive mode (in turn that's a subtle
   # side-effect of the underlying CreateFile(FILE_ATTRIBUTE_TEMPORARY))
   # and TP fails to open the passed path.
   tmp_perf_file = tempfile.NamedTemporaryFile(delete=False)
-  result_str += f"{yellow(args.no_colors)}[ RUN      ]{end_color_str} "
-  result_str += f"{test_name}\n"
-
+  tmp_perf_file.close()
   tmp_perf_path = tmp_perf_file.name
-  if test.type == 'queries':
-    query_path = test.query_path_or_metric
 
-    if not os.path.exists(test.query_path_or_metric):
-      result_str += f"Query file not found {query_path}"
-      return test_name, False, result_str, ""
+  gen_trace_file = None
+  gen_trace_pipe = None
+  if is_generated_trace:
+    gen_trace = generate_trace(trace_descriptor_path,
+                               tuple(extension_descriptor_paths), trace_path)
+    # The perf file records the ingestion time, which has to be measured
+    # with trace processor loading the trace from a regular file.
+    if USE_TRACE_PIPES and not args.keep_input and not args.perf_file:
+      gen_trace_pipe = TracePipe(gen_trace)
+      gen_trace_path = gen_trace_pipe.path
+    else:
+      gen_trace_file = tempfile.NamedTemporaryFile(delete=False)
+      gen_trace_file.write(gen_trace)
+      gen_trace_file.close()
+      gen_trace_path = os.path.realpath(gen_trace_file.name)
+  else:
+    gen_trace_path = trace_path
+
+  result_str += f"{yellow(args.no_colors)}[ RUN      ]{end_color_str} "
+  result_str += f"{test_name}\n"
 
-    result = run_query_test(args.trace_processor, gen_trace_path, query_path,
-                            expected_path, tmp_perf_path)
-  elif test.type == 'metrics':
-    result = run_metrics_test(args.trace_processor, gen_trace_path,
+  try:
+    if test.type == 'queries':
+      result = run_query_test(args.trace_processor, gen_trace_path,
                               test.query_path_or_metric, expected_path,
-                              tmp_perf_path, metrics_message_factory)
-  else:
-    assert False
+                              tmp_perf_path)
+    elif test.type == 'metrics':
+      result = run_metrics_test(args.trace_processor, gen_trace_path,
+                                test.query_path_or_metric, expected_path,
+                                tmp_perf_path, metrics_message_factory)
+    else:
+      assert False
+  finally:
+    # Also when the run fails, otherwise the writer would stay blocked.
+    if gen_trace_pipe:
+      gen_trace_pipe.close()
 
-  perf_lines = [line.decode('utf8') for line in tmp_perf_file.readlines()]
-  tmp_perf_file.close()
-  os.remove(tmp_perf_file.name)
+  with open(tmp_perf_path, 'rb') as f:
+    perf_data = f.read()
+  os.remove(tmp_perf_path)
 
   if gen_trace_file:
     if args.keep_input:
       result_str += f"Saving generated input trace: {gen_trace_path}\n"
     else:
-      gen_trace_file.close()
       os.remove(gen_trace_path)
 
   def write_cmdlines():
@@ -273,23 +528,34 @@ def run_test(trace_descriptor_path, extension_descriptor_paths, args, test):
           os.path.relpath(trace_descriptor_path, ROOT_DIR),
           os.path.relpath(trace_path, ROOT_DIR),
           os.path.relpath(gen_trace_path, ROOT_DIR))
+      if gen_trace_pipe:
+        res += 'The generated trace was streamed to trace processor: '
+        res += 'use --keep-input to save it.\n'
     res += f"Command line:\n{' '.join(result.cmd)}\n"
     return res
 
-  expected_content = result.expected.replace('\r\n', '\n')
-  actual_content = result.actual.replace('\r\n', '\n')
-  contents_equal = (expected_content == actual_content)
+  # The outputs are compared as bytes and only normalized (and decoded) if they
+  # differ: this avoids copying both outputs in the common case of a passing
+  # test.
+  contents_equal = (
+      result.expected == result.actual or
+      result.expected.replace(b'\r\n', b'\n') == result.actual.replace(
+          b'\r\n', b'\n'))
   if result.exit_code != 0 or not contents_equal:
-    result_str += result.stderr
+    details = result.stderr
 
     if result.exit_code == 0:
-      result_str += f"Expected did not match actual for trace "
-      result_str += f"{trace_path} and {result.test_type} {result.input_name}\n"
-      result_str += f"Expected file: {expected_path}\n"
-      result_str += write_cmdlines()
-      result_str += write_diff(result.expected, result.actual)
+      details += f"Expected did not match actual for trace "
+      details += f"{trace_path} and {result.test_type} {result.input_name}\n"
+      details += f"Expected file: {expected_path}\n"
+      details += write_cmdlines()
+      details += write_diff(result.expected, result.actual)
     else:
-      result_str += write_cmdlines()
+      details += write_cmdlines()
+
+    if len(details) > MAX_FAILURE_DETAILS_SIZE:
+      details = details[:MAX_FAILURE_DETAILS_SIZE] + '...(truncated)\n'
+    result_str += details
 
     result_str += f"{red_str}[     FAIL ]{end_color_str} {test_name} "
     result_str += f"{os.path.basename(trace_path)}\n"
@@ -297,48 +563,78 @@ def run_test(trace_descriptor_path, extension_descriptor_paths, args, test):
     if args.rebase:
       if result.exit_code == 0:
         result_str += f"Rebasing {expected_path}\n"
-        with open(expected_path, 'w') as f:
+        with open(expected_path, 'wb') as f:
           f.write(result.actual)
         rebased += 1
       else:
         result_str += f"Rebase failed for {expected_path} as query failed\n"
 
-    return test_name, False, result_str, ""
+    return TestOutcome(test_name, False, result_str, None, None)
   else:
-    assert len(perf_lines) == 1
-    perf_numbers = perf_lines[0].split(',')
-
-    assert len(perf_numbers) == 2
-    perf_result = PerfResult(test.type, trace_path, test.query_path_or_metric,
-                             perf_numbers[0], perf_numbers[1])
+    ingest_time_ns_str, real_time_ns_str = perf_data.decode(
+        'utf8').strip().split(',')
+    ingest_time_ns = int(ingest_time_ns_str)
+    real_time_ns = int(real_time_ns_str)
 
     result_str += f"{green_str}[       OK ]{end_color_str} "
     result_str += f"{os.path.basename(test.query_path_or_metric)} "
     result_str += f"{os.path.basename(trace_path)} "
-    result_str += f"(ingest: {perf_result.ingest_time_ns / 1000000:.2f} ms "
-    result_str += f"query: {perf_result.real_time_ns / 1000000:.2f} ms)\n"
-  return test_name, True, result_str, perf_result
+    result_str += f"(ingest: {ingest_time_ns / 1000000:.2f} ms "
+    result_str += f"query: {real_time_ns / 1000000:.2f} ms)\n"
+  return TestOutcome(test_name, True, result_str, ingest_time_ns, real_time_ns)
+
+
+# Arguments shared by all the tests run by a ProcessPoolExecutor worker. Set
+# once per worker by init_worker() so that they are not pickled for each test.
+worker_run_test_args = None
 
 
-def run_all_tests(trace_descriptor_path, extension_descriptor_paths, args,
-                  tests):
+def init_worker(trace_descriptor_path, extension_descriptor_paths,
+                metrics_descriptor_paths, args):
+  global worker_run_test_args
+  worker_run_test_args = (trace_descriptor_path, extension_descriptor_paths,
+                          get_metrics_message_factory(metrics_descriptor_paths),
+                          args)
+
+
+def run_tests_in_worker(tests):
+  return [run_test(*worker_run_test_args, test) for test in tests]
+
+
+def run_all_tests(trace_descriptor_path, extension_descriptor_paths,
+                  metrics_descriptor_paths, args, tests):
   perf_data = []
   test_failure = []
   rebased = 0
-  with concurrent.futures.ProcessPoolExecutor() as e:
-    fut = [
-        e.submit(run_test, trace_descriptor_path, extension_descriptor_paths,
-                 args, test) for test in tests
-    ]
-    for res in concurrent.futures.as_completed(fut):
-      test_name, test_passed, res_str, perf_result = res.result()
-      sys.stderr.write(res_str)
-      if test_passed:
-        perf_data.append(perf_result)
-        if args.rebase:
-          rebased += 1
-      else:
-        test_failure.append(test_name)
+  # Send the tests to the workers in batches to reduce the IPC overhead of the
+  # many short tests.
+  chunksize = max(1, len(tests) // ((os.cpu_count() or 1) * 4))
+  with concurrent.futures.ProcessPoolExecutor(
+      initializer=init_worker,
+      initargs=(trace_descriptor_path, extension_descriptor_paths,
+                metrics_descriptor_paths, args)) as e:
+    chunks = [tests[i:i + chunksize] for i in range(0, len(tests), chunksize)]
+    futures = [e.submit(run_tests_in_worker, chunk) for chunk in chunks]
+    stderr_buf = []
+    for chunk, future in zip(chunks, futures):
+      if not future.done():
+        # Print what we have before waiting for more results.
+        sys.stderr.write(''.join(stderr_buf))
+        stderr_buf.clear()
+      for test, outcome in zip(chunk, future.result()):
+        stderr_buf.append(outcome.result_str)
+        if len(stderr_buf) >= STDERR_FLUSH_RESULTS:
+          sys.stderr.write(''.join(stderr_buf))
+          stderr_buf.clear()
+        if outcome.passed:
+          perf_data.append(
+              PerfResult(test.type, test.trace_path, test.query_path_or_metric,
+                         outcome.ingest_time_ns, outcome.real_time_ns))
+          if args.rebase:
+            rebased += 1
+        else:
+          test_failure.append(outcome.name)
+    sys.stderr.write(''.join(stderr_buf))
 
   return test_failure, perf_data, rebased
 
@@ -347,21 +643,25 @@ def read_all_tests_from_index(index_path, query_metric_pattern, trace_pattern):
   index_dir = os.path.dirname(index_path)
 
   with open(index_path, 'r') as index_file:
-    index_lines = index_file.readlines()
+    index = index_file.read()
 
-  tests = []
-  for line in index_lines:
-    stripped = line.strip()
-    if stripped.startswith('#'):
-      continue
-    elif not stripped:
-      continue
+  matches = INDEX_LINE_PATTERN.findall(index)
+  if len(matches) != len(INDEX_NON_COMMENT_LINE_PATTERN.findall(index)):
+    for line in index.splitlines():
+      stripped = line.strip()
+      if (stripped and not stripped.startswith('#') and
+          not INDEX_LINE_PATTERN.fullmatch(line)):
+        raise ValueError(f"Malformed line in {index_path}: {line}")
 
-    [trace_fname, query_fname_or_metric, expected_fname] = stripped.split(' ')
-    if not query_metric_pattern.match(os.path.basename(query_fname_or_metric)):
+  tests = []
+  for trace_fname, query_fname_or_metric, expected_fname in matches:
+    # The patterns are None when not filtering, to skip the regex entirely.
+    if query_metric_pattern and not query_metric_pattern.fullmatch(
+        os.path.basename(query_fname_or_metric)):
       continue
 
-    if not trace_pattern.match(os.path.basename(trace_fname)):
+    if trace_pattern and not trace_pattern.fullmatch(
+        os.path.basename(trace_fname)):
       continue
 
     trace_path = os.path.abspath(os.path.join(index_dir, trace_fname))
@@ -375,8 +675,20 @@ def read_all_tests_from_index(index_path, query_metric_pattern, trace_pattern):
       test_type = 'metrics'
       query_path_or_metric = query_fname_or_metric
 
+    # Check that the files exist here, in a single sequential pass, rather
+    # than in the workers.
+    if not os.path.exists(trace_path):
+      missing_file_error = f"Trace file not found {trace_path}\n"
+    elif not os.path.exists(expected_path):
+      missing_file_error = f"Expected file not found {expected_path}\n"
+    elif test_type == 'queries' and not os.path.exists(query_path_or_metric):
+      missing_file_error = f"Query file not found {query_path_or_metric}\n"
+    else:
+      missing_file_error = None
+
     tests.append(
-        Test(test_type, trace_path, query_path_or_metric, expected_path))
+        Test(test_type, trace_path, query_path_or_metric, expected_path,
+             missing_file_error))
   return tests
 
 
@@ -414,12 +726,14 @@ def main():
       '--query-metric-filter',
       default='.*',
       type=str,
-      help='Filter the name of query files or metrics to test (regex syntax)')
+      help='Filter the name of query files or metrics to test (regex syntax, '
+      'must match the whole name)')
   parser.add_argument(
       '--trace-filter',
       default='.*',
       type=str,
-      help='Filter the name of trace files to test (regex syntax)')
+      help='Filter the name of trace files to test (regex syntax, must match '
+      'the whole name)')
   parser.add_argument(
       '--keep-input',
       action='store_true',
@@ -434,8 +748,11 @@ def main():
       'trace_processor', type=str, help='location of trace processor binary')
   args = parser.parse_args()
 
-  query_metric_pattern = re.compile(args.query_metric_filter)
-  trace_pattern = re.compile(args.trace_filter)
+  def compile_filter(pattern):
+    return None if pattern == '.*' else re.compile(pattern)
+
+  query_metric_pattern = compile_filter(args.query_metric_filter)
+  trace_pattern = compile_filter(args.trace_filter)
 
   tests = read_all_tests(query_metric_pattern, trace_pattern)
   sys.stderr.write(f"[==========] Running {len(tests)} tests.\n")
@@ -455,6 +772,17 @@ def main():
       trace_descriptor_path = find_trace_descriptor(
           os.path.join(out_path, 'gcc_like_host'))
 
+  if args.metrics_descriptor:
+    metrics_descriptor_paths = (args.metrics_descriptor,)
+  else:
+    metrics_protos_path = os.path.join(out_path, 'gen', 'protos', 'perfetto',
+                                       'metrics')
+    metrics_descriptor_paths = (
+        os.path.join(metrics_protos_path, 'metrics.descriptor'),
+        os.path.join(metrics_protos_path, 'chrome',
+                     'all_chrome_metrics.descriptor'),
+    )
+
   chrome_extensions = os.path.join(out_path, 'gen', 'protos', 'third_party',
                                    'chromium', 'chrome_track_event.descriptor')
   test_extensions = os.path.join(out_path, 'gen', 'protos', 'perfetto', 'trace',
@@ -462,7 +790,8 @@ def main():
 
   test_run_start = datetime.datetime.now()
   test_failures, perf_data, rebased = run_all_tests(
-      trace_descriptor_path, [chrome_extensions, test_extensions], args, tests)
+      trace_descriptor_path, [chrome_extensions, test_extensions],
+      metrics_descriptor_paths, args, tests)
   test_run_end = datetime.datetime.now()
   test_time_ms = int((test_run_end - test_run_start).total_seconds() * 1000)
 
@@ -486,42 +815,49 @@ def main():
       test_dir = os.path.join(ROOT_DIR, 'test')
       trace_processor_dir = os.path.join(test_dir, 'trace_processor')
 
+      # Many tests share the same trace or query file.
+      relpath = functools.lru_cache(maxsize=None)(os.path.relpath)
+
       metrics = []
       sorted_data = sorted(
           perf_data,
           key=lambda x: (x.test_type, x.trace_path, x.query_path_or_metric))
       for perf_args in sorted_data:
-        trace_short_path = os.path.relpath(perf_args.trace_path, test_dir)
+        trace_short_path = relpath(perf_args.trace_path, test_dir)
 
         query_short_path_or_metric = perf_args.query_path_or_metric
         if perf_args.test_type == 'queries':
-          query_short_path_or_metric = os.path.relpath(
-              perf_args.query_path_or_metric, trace_processor_dir)
-
+          query_short_path_or_metric = relpath(perf_args.query_path_or_metric,
+                                               trace_processor_dir)
+
+        # Both metrics of a test have the same tags.
+        tags = {
+            'test_name': f"{trace_short_path}-{query_short_path_or_metric}",
+            'test_type': perf_args.test_type,
+        }
         metrics.append({
             'metric': 'tp_perf_test_ingest_time',
             'value': float(perf_args.ingest_time_ns) / 1.0e9,
             'unit': 's',
-            'tags': {
-                'test_name': f"{trace_short_path}-{query_short_path_or_metric}",
-                'test_type': perf_args.test_type,
-            },
+            'tags': tags,
             'labels': {},
         })
         metrics.append({
             'metric': 'perf_test_real_time',
             'value': float(perf_args.real_time_ns) / 1.0e9,
             'unit': 's',
-            'tags': {
-                'test_name': f"{trace_short_path}-{query_short_path_or_metric}",
-                'test_type': perf_args.test_type,
-            },
+            'tags': tags,
             'labels': {},
         })
 
       output_data = {'metrics': metrics}
-      with open(args.perf_file, 'w+') as perf_file:
-        perf_file.write(json.dumps(output_data, indent=2))
+      if orjson:
+        with open(args.perf_file, 'wb') as perf_file:
+          perf_file.write(
+              orjson.dumps(output_data, option=orjson.OPT_INDENT_2))
+      else:
+        with open(args.perf_file, 'w+') as perf_file:
+          perf_file.write(json.dumps(output_data, indent=2))
     return 0
   else:
     for failure in test_failures:
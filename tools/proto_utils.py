@@ -74,4 +74,5 @@ def serialize_python_trace(trace_descriptor_path, python_trace_path,
         os.path.join(ROOT_DIR, 'test'), env['PYTHONPATH'])
   else:
     env['PYTHONPATH'] = os.path.join(ROOT_DIR, 'test')
-  subprocess.check_call(python_cmd, env=env, stdout=out_stream)
+  out_stream.write(subprocess.check_output(python_cmd, env=env))
+  out_stream.flush()